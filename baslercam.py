@@ -3,14 +3,19 @@ import time
 import glob
 import av
 import cv2
+import queue
 import threading
+from functools import lru_cache
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 
 import numpy as np
 from pypylon import pylon
-from PIL import Image
-from scipy.ndimage import laplace
 
-to_rgb = {'Mono8':cv2.COLOR_GRAY2RGB, 'BGR8':cv2.COLOR_BGR2RGB}
+# CUDA-enabled OpenCV builds can compute the image sharpness on the GPU (see `get_imgprops`)
+has_cuda = hasattr(cv2, 'cuda') and cv2.cuda.getCudaEnabledDeviceCount() > 0
+_cuda_laplacian = None
 
 class save:
     """ A simple class to instruct the camera to acquire images ; 
@@ -18,7 +23,8 @@ class save:
     acquired """
     def __init__(self, t=None, t0=time.time()):
         self.lock = threading.Lock()
-        self.save = False
+        self._trigger = threading.Event()     # Set when an image has to be saved
+        self._last_due = -1                   # Index of the last time of `t` that has passed (see `check_time`)
         self.t0 = t0
         self.t = t
         self.index = 0
@@ -28,28 +34,62 @@ class save:
             self.t0 = t0
 
     def check_time(self):
+        """ Triggers a save if (at least) the next time in `t` has passed. If we are late and 
+        several have passed, they are all consumed by that one save """
         if self.t is not None:
-            if time.time() - self.t0 > self.t[self.index]:
+            idx = np.searchsorted(self.t, time.time() - self.t0, side='right')
+            if idx > self.index:
+                self._last_due = idx - 1
                 self.set_trigger()
 
+    def time_to_next(self):
+        """ The time (in s) left before the next save, None if no times were given (or all are done) """
+        if self.t is None or self.index >= len(self.t):
+            return None
+        return self.t[self.index] - (time.time() - self.t0)
+
+    @property
+    def save(self):
+        """ Kept so that `extsave.save = True` still works """
+        return self._trigger.is_set()
+
+    @save.setter
+    def save(self, value):
+        if value:
+            self._trigger.set()
+        else:
+            self._trigger.clear()
+
     def set_trigger(self):
-        with self.lock:
-            self.save = True
+        self._trigger.set()
 
     def get_trigger(self):
-        return self.save
+        return self._trigger.is_set()
     
     def complete(self):
-        with self.lock:
-            self.save = False
-            self.index += 1
+        self._trigger.clear()
+        self.index = max(self.index, self._last_due) + 1     # Only touched by the camera thread
 
     def get_index(self):
         return self.index
 
 
 
-def get_imgprops(data:np.ndarray, roi=None):
+def _gpu_imgprops(data:np.ndarray):
+    """ The GPU version of the luminance / sharpness computation of `get_imgprops` """
+    global _cuda_laplacian
+    if _cuda_laplacian is None:     # The filter is only built once
+        _cuda_laplacian = cv2.cuda.createLaplacianFilter(cv2.CV_32FC1, cv2.CV_32FC1, ksize=1)
+
+    gpu_data = cv2.cuda_GpuMat()
+    gpu_data.upload(np.ascontiguousarray(data))
+    gpu_data = gpu_data.convertTo(cv2.CV_32F)
+    lum_now = cv2.cuda.sum(gpu_data)[0] / data.size
+    norm_grad = cv2.cuda.sqrSum(_cuda_laplacian.apply(gpu_data))[0] / data.size
+
+    return lum_now, norm_grad
+
+def get_imgprops(data:np.ndarray, roi=None, use_gpu=False):
     """ A function that builds some kind of arbitrary
     sharpness value from a numpy array (treated as an image).
     Based on statistics on the normed gradient of the image
@@ -58,7 +98,9 @@ def get_imgprops(data:np.ndarray, roi=None):
     ARGS
     -----
     - data : your image in np.ndarray format
-    - roi : [top, down, left, right] : the region of interest on which to focus"""
+    - roi : [top, down, left, right] : the region of interest on which to focus
+    - use_gpu [default False] : do the computation on a CUDA GPU. Needs an OpenCV build 
+    with CUDA, otherwise we silently fall back on the CPU"""
 
     if data.ndim == 3:
         data = data[:,:,1]
@@ -67,9 +109,23 @@ def get_imgprops(data:np.ndarray, roi=None):
         h, w = data.shape
         roi = [2*h//5,(3*h)//5, 2*w//5, (3*w)//5]
     data = data[roi[0]:roi[1], roi[2]:roi[3]]
+    if data.dtype not in (np.uint8, np.uint16, np.int16, np.float32, np.float64):    # What OpenCV can filter
+        data = data.astype(np.float32)
 
-    lum_now = np.mean(data)
-    norm_grad = np.mean(np.abs(laplace(data - lum_now))**2) # Dividing by the std is not good since out of focus --> smaller std.
+    if use_gpu and has_cuda:
+        return _gpu_imgprops(data)
+
+    # Same 4-neighbour stencil as scipy's `laplace`. 8-bit images fit in int16, deeper ones go to float
+    if data.dtype == np.uint8:
+        ddepth = cv2.CV_16S
+    elif data.dtype == np.float64:
+        ddepth = cv2.CV_64F
+    else:
+        ddepth = cv2.CV_32F
+    lum_now = cv2.mean(data)[0]
+    lap = cv2.Laplacian(data, ddepth, ksize=1)  # The Laplacian kernel sums to zero, no need to subtract lum_now.
+    lap_mean, lap_std = cv2.meanStdDev(lap)     # <lap^2> = std^2 + mean^2, without building the lap^2 array
+    norm_grad = lap_std[0,0]**2 + lap_mean[0,0]**2 # Dividing by the std is not good since out of focus --> smaller std.
 
     return lum_now, norm_grad
 
@@ -138,8 +194,106 @@ def init(width=None, height=None, exposure='auto', binning=1) -> pylon.InstantCa
     return cam
 
 
+def _video_pix_fmt(pix_fmt, width, height):
+    """ libx265 needs even image sizes for chroma subsampled formats (width and height for yuv420p,
+    width for yuv422p). Falls back on yuv444p (no subsampling) when the frames do not fit `pix_fmt` """
+    if (pix_fmt.startswith('yuv420') and (width % 2 or height % 2)) or (pix_fmt.startswith('yuv422') and width % 2):
+        print(f'baslercam > {width} x {height} frames cannot be encoded with {pix_fmt}, using yuv444p instead')
+        return 'yuv444p'
+    return pix_fmt
+
+
+def _writer(writer_q, save_folder='.', saveasvideo=True, width=None, height=None, vid_format='bgr24',
+            pix_fmt='yuv420p', shm_names=None, shape=None, free_q=None, slots=None):
+    """ The side thread (or process) of `acquire` : takes the (slot, index) tuples 
+    from `writer_q`, saves the image in `slots[slot]` (video or .tif) and hands the slot
+    back through `free_q`, until it receives `None`. Encoding releases the GIL so that 
+    the camera can keep on grabbing in the meantime. If anything goes wrong, the exception
+    is put in `free_q` instead of a slot (for `acquire` to raise it) and the writer stops.
+
+    In process mode, the slots are rebuilt from the shared memory blocks in `shm_names`
+    (holding images of size `shape`) """
+
+    if shm_names is not None:
+        shms = [shared_memory.SharedMemory(name=name) for name in shm_names]
+        slots = [np.ndarray(shape, dtype=np.uint8, buffer=shm.buf) for shm in shms]
+
+    container = None
+    failed = False
+    try:
+        # Frames are pushed in the video as soon as they arrive. Fast presets so that 
+        # the encoder keeps up with the acquisition
+        if saveasvideo:
+            container = av.open(save_folder + '/exp.mp4', mode='w')
+            stream = container.add_stream("libx265", rate=24, options={'crf':'18', 'preset':'ultrafast', 'tune':'zerolatency', 
+                                                                        'x265-params':'log-level=error'})
+            stream.pix_fmt = pix_fmt
+            stream.height, stream.width = height, width
+
+        while True:
+            item = writer_q.get()
+            if item is None:
+                break
+            slot, saveidx = item
+            frame = slots[slot]
+
+            # Save frame : OpenCV / PyAV natively deal with Mono8 and BGR8 frames, no conversion needed
+            if saveasvideo:
+                for packet in stream.encode(av.VideoFrame.from_ndarray(frame, format=vid_format)):
+                    container.mux(packet)
+            else:
+                imgurl = save_folder + f'/img_{saveidx:06d}.tif'
+                if not cv2.imwrite(imgurl, frame, [cv2.IMWRITE_TIFF_COMPRESSION, 1]):    # OpenCV does not raise by itself
+                    raise IOError(f'baslercam._writer > Could not save {imgurl}')
+
+            free_q.put(slot)
+
+    except Exception as err:
+        failed = True
+        free_q.put(err)
+
+    finally:
+        if container is not None:       # Finish video (no point in flushing an encoder that failed)
+            if not failed:
+                for packet in stream.encode():
+                    container.mux(packet)
+            container.close()
+        if shm_names is not None:   # Views on the shared memory have to go before we close it
+            frame = slots = None
+            for shm in shms:
+                shm.close()
+
+
+def _free_slot(free_q, writer):
+    """ Takes a free slot from `free_q` (see `acquire`). Raises the writer's exception if it 
+    failed, or a RuntimeError if it died without saying anything, instead of waiting forever """
+    while True:
+        try:
+            item = free_q.get(timeout=0.5)
+        except queue.Empty:
+            if writer.is_alive():
+                continue
+            item = _writer_error(free_q)    # Maybe the error arrived just before the writer died
+            if item is None:
+                item = RuntimeError('baslercam.acquire > The writer stopped unexpectedly')
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+def _writer_error(free_q):
+    """ Looks for an exception left in `free_q` by a failed `_writer` (None if there is none) """
+    while True:
+        try:
+            item = free_q.get(timeout=0.1)
+        except queue.Empty:
+            return None
+        if isinstance(item, BaseException):
+            return item
+
+
 def acquire(cam:pylon.InstantCamera, save_folder='.', dt=None, max_time=None,
-                   t=None, abort_thread=None, extsave=None):
+                   t=None, abort_thread=None, extsave=None, saveasvideo=True, display_scale=0.5, use_process=False, 
+                   use_gpu=False, pix_fmt='yuv420p', verbose=True):
     
     """ ACQUIRE_FRAMES () : Runs an acquisition and saves images 
     
@@ -152,16 +306,18 @@ def acquire(cam:pylon.InstantCamera, save_folder='.', dt=None, max_time=None,
     * save_folder [default '.'] : where you want to save the images
     * abort_thread [threading.Event type] : the "kill switch" from main process if you want to run this as a thread 
     * save_event [class save_event from this file] : a 'flag' that you can set in another process to instruct the camera to save from time to time
+    * saveasvideo [default True] : encode the saved frames directly in `exp.mp4` instead of writing one .tif file per frame
+    * display_scale [default 0.5] : the size of the live feed window relative to the full frame (saved images are always full size)
+    * use_process [default False] : save the frames from a separate process (frames are passed through shared memory) instead 
+    of a thread. Useful for large / fast sensors, when the acquisition loop and the encoder fight for the GIL.
+    * use_gpu [default False] : compute the image sharpness on a CUDA GPU (if OpenCV has been built with CUDA), see `get_imgprops`
+    * pix_fmt [default 'yuv420p'] : the pixel format of the video, see `make_video`
+    * verbose [default True] : print the info about each saved frame in the standard output
     
     NOTE: now, by default, we save the results as a video. If you don't want that
-    please set the `saveasvideo` option to `False`.""" 
+    please set the `saveasvideo` option to `False` (e.g. if you want to check the sharpness of individual images).
+    NOTE: with `use_process`, your main script needs the usual `if __name__ == '__main__':` guard (at least on Windows).""" 
     
-    # Write header file
-    headerstr = f'{"no":7s}\t{"texp":8s}\t{"tlocal":15s}\t{"expos":7s}\t{"lumi":7s}\t{"sharp":7s}'
-    print(headerstr)
-    with open(save_folder + '/camera_log.txt', 'w') as logfile:
-        logfile.write(headerstr.replace('\t', ',') + '\n')
-
     # Deal with t's, delta t's, etc.
     # I use the `save` class which basically instructs the programme
     # to save images following a flag being set in there
@@ -169,7 +325,7 @@ def acquire(cam:pylon.InstantCamera, save_folder='.', dt=None, max_time=None,
         t_snap = np.arange(0,max_time+dt,dt)
         mysave = save(t=t_snap)
     elif t is not None:
-        t_snap = np.array(t_snap)
+        t_snap = np.array(t)
         max_time = t_snap[-1] + 1
         mysave = save(t=t_snap)
     elif max_time is not None and extsave is not None:
@@ -178,13 +334,47 @@ def acquire(cam:pylon.InstantCamera, save_folder='.', dt=None, max_time=None,
         raise ValueError('acquire_frames > You must specify [a list of times with `t`] / [a `max_time` and a `dt`] / [a `max_time` and an external save variable]')
 
 
+    # Write header file. The log file stays open during the whole acquisition
+    if verbose:
+        print(f'{"no":7s}\t{"texp":8s}\t{"tlocal":15s}\t{"expos":7s}\t{"lumi":7s}\t{"sharp":7s}')
+    logfile = open(save_folder + '/camera_log.txt', 'w')
+    logfile.write('no,texp,tlocal,expos,lumi,sharp\n')
+
     # The try / finally will allow us to finish the video 
     # even if there is an issue somewhere else in the programme     
+    writer = None
+    shms = []
     try: 
         
         cv2.namedWindow('Live Feed')
         cam.StartGrabbing(pylon.GrabStrategy_LatestImages)
 
+        # Saving is done on the side so that it does not block the next trigger. Frames go 
+        # through a pool of 8 preallocated slots, the writer gives them back through `free_q` 
+        # once they are saved (so no new array per saved frame)
+        width, height = cam.Width.Value, cam.Height.Value
+        vid_format = 'gray' if cam.PixelFormat.Value == 'Mono8' else 'bgr24'
+        shape = (height, width) if vid_format == 'gray' else (height, width, 3)
+        if saveasvideo:
+            pix_fmt = _video_pix_fmt(pix_fmt, width, height)
+        if use_process:     # Slots live in shared memory
+            shms = [shared_memory.SharedMemory(create=True, size=int(np.prod(shape))) for _ in range(8)]
+            slots = [np.ndarray(shape, dtype=np.uint8, buffer=shm.buf) for shm in shms]
+            writer_q, free_q = mp.Queue(), mp.Queue()
+            writer = mp.Process(target=_writer, args=(writer_q, save_folder, saveasvideo, width, height, vid_format, pix_fmt,
+                                                      [shm.name for shm in shms], shape, free_q))
+        else:
+            slots = [np.empty(shape, dtype=np.uint8) for _ in range(8)]
+            writer_q, free_q = queue.Queue(), queue.Queue()
+            writer = threading.Thread(target=_writer, args=(writer_q, save_folder, saveasvideo, width, height, vid_format, pix_fmt),
+                                      kwargs={'free_q':free_q, 'slots':slots})
+        for slot in range(len(slots)):
+            free_q.put(slot)
+        writer.start()
+
+        # Downsampled live feed : displaying full frames is costly on large sensors
+        disp_size = (int(width*display_scale), int(height*display_scale))
+
         t0 = time.time()
         mysave.set_t0(t0=t0)
 
@@ -199,52 +389,80 @@ def acquire(cam:pylon.InstantCamera, save_folder='.', dt=None, max_time=None,
                 cam.ExecuteSoftwareTrigger()
             grabResult = cam.RetrieveResult(500, pylon.TimeoutHandling_ThrowException) 
 
-            # If grab succeeded, see what we do with the image
-            if grabResult.GrabSucceeded():
-                frame = grabResult.Array
+            # If grab failed, just try again
+            if not grabResult.GrabSucceeded():
+                grabResult.Release()
+                continue
+
+            # NOTE : `frame` is a view on pylon's own buffer (no copy), it is only 
+            # valid inside the `with` block
+            with grabResult.GetArrayZeroCopy() as frame:
                 timestamp = grabResult.TimeStamp
-                img_lum, img_sharp = get_imgprops(frame.astype(np.int32))
-                exposure = cam.ExposureTime.Value
+                img_lum, img_sharp = get_imgprops(frame, use_gpu=use_gpu)
 
-            cv2.imshow('Live Feed', frame)
-            cv2.waitKey(1)    # Enforces display & waits for 1 ms. Somehow programme crashes at the end for larger values...
+                if display_scale != 1:
+                    cv2.imshow('Live Feed', cv2.resize(frame, disp_size, interpolation=cv2.INTER_AREA))
+                else:
+                    cv2.imshow('Live Feed', frame)
+
+                # If we have specified times for our `save` object, check if these times may 
+                # trigger frame save
+                mysave.check_time()
 
-            # If we have specified times for our `save` object, check if these times may 
-            # trigger frame save
-            mysave.check_time()
+                # Save if we need to
+                if mysave.get_trigger():
+                    
+                    saveidx = mysave.get_index()
+                    exposure = cam.ExposureTime.Value   # Camera settings are only queried when we need them
 
-            # Save if we need to
-            if mysave.get_trigger():
-                
-                saveidx = mysave.get_index()
+                    # Hand a copy of the frame over to the writer
+                    slot = _free_slot(free_q, writer)     # Waits if the writer lags behind
+                    np.copyto(slots[slot], frame)
+                    writer_q.put((slot, saveidx))
 
-                # Convert and save frame
-                if cam.PixelFormat.Value != 'RGB8':
-                    rgbframe = cv2.cvtColor(frame, to_rgb[cam.PixelFormat.Value])       # Deal with nonstandard pixel formats
-                pilimg = Image.fromarray(rgbframe, mode='RGB')
-                pilimg.save(save_folder + f'/img_{saveidx:06d}.tif')
+                    # Write about the saved frame
+                    t_save = time.time() - t0
+                    logfile.write(f'{saveidx},{t_save:.2f},{timestamp},{exposure:.1f},{img_lum:.1f},{img_sharp:.2f}\n')
+                    if verbose:
+                        print(f'{saveidx:5d}\t{t_save:8.2f}\t{timestamp:12d}\t{exposure:7.1f}\t{img_lum:5.1f}\t{img_sharp:6.2f}')
 
-                # # Write about the saved frame 
-                datastr = f'{saveidx:5d}\t{time.time()-t0:8.2f}\t{timestamp:12d}\t{exposure:7.1f}\t{img_lum:5.1f}\t{img_sharp:6.2f}'
-                with open(save_folder + '/camera_log.txt', 'a') as logfile:
-                    logfile.write(datastr.replace('\t', ',') + '\n')
-                print(datastr)
+                    mysave.complete()
 
-                mysave.complete()
+            grabResult.Release()
+            cv2.waitKey(1)    # Enforces display & waits for 1 ms. Somehow programme crashes at the end for larger values...
+
+            # No need to spin when the next save is far away. We still wake up 
+            # every 50 ms or so to refresh the live feed and check for aborts
+            t_next = mysave.time_to_next()
+            if t_next is not None:
+                time.sleep(min(max(0, t_next - 0.02), 0.05))
 
     # Stop acquisition if keyboard interrupt (this time if this function is directly called)
     except KeyboardInterrupt:
         print('acquire > Keyboard Interruption ...')
 
     finally:
+        writer_err = None
+        if writer is not None:          # Let the writer save the remaining frames (and finish the video)
+            if writer.is_alive():
+                writer_q.put(None)
+                writer.join()
+            writer_err = _writer_error(free_q)
+        slots = None
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+        logfile.close()
         cv2.destroyWindow('Live Feed')
         cam.Close()
         print('baslercam.acquire >> Camera Acquisition Complete')
+        if writer_err is not None:
+            raise writer_err
 
 ############################# UTILITIES ###################################################################
 ###########################################################################################################
 
-def make_video(save_folder, expr='*.tif*', cleanup=False):
+def make_video(save_folder, expr='*.tif*', cleanup=False, pix_fmt='yuv420p'):
         """ Makes a video from a list of .TIFF files 
         
         ARGS
@@ -252,25 +470,35 @@ def make_video(save_folder, expr='*.tif*', cleanup=False):
         * save_folder : where the TIFF /etc. files are
         * expr [default '*.tif*'] : what to look for in the folder to make the video
         * cleanup [default False] : delete the original images after video is successfully made
+        * pix_fmt [default 'yuv420p'] : the pixel format of the video. Use 'yuv444p' if you do not want to lose 
+        any color info (encoding is then about twice slower and files are bigger)
 
-        NOTE : The videos are made using libx265 and yuv444p pixel space so as to not lose color info
+        NOTE : The videos are made using libx265. With 'yuv420p', image width and height have to be even 
+        (we switch to 'yuv444p' otherwise).
         """
 
         # Initialise video ... (need a test frame)
         imgurls = glob.glob(save_folder + '/' + expr)
-        test_frame = Image.open(imgurls[0])
+        test_frame = cv2.imread(imgurls[0], cv2.IMREAD_COLOR)
         
         container = av.open(save_folder + '/exp.mp4', mode='w')
         stream = container.add_stream("libx265", rate=24, options={'crf':'13', 'x265-params':'log-level=error'})
-        stream.pix_fmt = "yuv444p"
         stream.height, stream.width = np.shape(test_frame)[:2]
-
-        for no, imgurl in enumerate(imgurls):
-            frame = av.VideoFrame.from_image(Image.open(imgurl))
-            for packet in stream.encode(frame):
-                container.mux(packet)
-            if no % 100 == 0:
-                print(f'vimbacam.make_video > {no} / {len(imgurls)} frames', end='\r')
+        stream.pix_fmt = _video_pix_fmt(pix_fmt, stream.width, stream.height)
+
+        # Frames are decoded in a side thread, one frame ahead of the encoder 
+        # (both release the GIL, so they actually run in parallel)
+        with ThreadPoolExecutor(max_workers=1) as decoder:
+            next_img = decoder.submit(cv2.imread, imgurls[0], cv2.IMREAD_COLOR)
+            for no in range(len(imgurls)):
+                img = next_img.result()
+                if no + 1 < len(imgurls):
+                    next_img = decoder.submit(cv2.imread, imgurls[no+1], cv2.IMREAD_COLOR)
+                frame = av.VideoFrame.from_ndarray(img, format='bgr24')
+                for packet in stream.encode(frame):
+                    container.mux(packet)
+                if no % 100 == 0:
+                    print(f'vimbacam.make_video > {no} / {len(imgurls)} frames', end='\r')
 
         # Finish video eventually
         for packet in stream.encode():
@@ -296,13 +524,20 @@ def make_logtimes(dt0=0.5, tmax=3600, pts_per_decade=20):
     * pts_per_decade [int] : the number of points you want to take before multiplying delta t by 10.
     """
 
+    alpha, N, dtmax, dt_scale = _logtimes(dt0, tmax, pts_per_decade)
+    T_total = np.sum(dt_scale)
+    print(f'make_logspace > N = {N:.3f} frames, total time = {T_total:.2f} s, alpha = {alpha:.2f}, dtmax = {dtmax:.3f}')
+    return dt_scale.copy() # The cached array is shared, so callers get their own copy
+
+@lru_cache(maxsize=32)
+def _logtimes(dt0, tmax, pts_per_decade):
+    """ Does the actual work of `make_logtimes` (cached, the same scales tend to be asked for over and over) """
     alpha = np.log(10)/pts_per_decade
     N = int(1/alpha*np.log(1+tmax/dt0*(np.exp(alpha)-1)))
     dtmax = dt0*np.exp(alpha*N)
     dt_scale = np.logspace(np.log10(dt0), np.log10(dtmax), N)
-    T_total = np.sum(dt_scale)
-    print(f'make_logspace > N = {N:.3f} frames, total time = {T_total:.2f} s, alpha = {alpha:.2f}, dtmax = {dtmax:.3f}')
-    return np.logspace(np.log10(dt0), np.log10(dtmax), N)
+    dt_scale.flags.writeable = False
+    return alpha, N, dtmax, dt_scale
     
 
 ######################### TESTS #############################
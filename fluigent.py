@@ -6,7 +6,6 @@
 
 import Fluigent.SDK as fluigent
 import numpy as np
-import pandas as pd
 import time
 
 def init():
@@ -20,7 +19,7 @@ def close():
     return fgt_error
 
 def make_ramp(low=0, high=0, nsteps=1, tstep=1, repeats=2,
-              log_steps=False, reverse=False, symmetric=False):
+              log_steps=False, reverse=False, symmetric=False, return_df=False):
     """ MAKE_RAMP() : Creates a pressure ramp for you to play with 
     
     ARGS
@@ -33,6 +32,8 @@ def make_ramp(low=0, high=0, nsteps=1, tstep=1, repeats=2,
     * log_steps [bool, default False] : if you want to do logarithmic steps instead of linear
     * reverse [bool, default False] : if you want to start from high pressures and go to low ones 
     * symmetric [bool, default False] : adds a reverse ramp at the end of your ramp
+    * return_df [bool, default False] : returns a pandas DataFrame instead of a dict of numpy arrays
+    (nicer to look at, but slower to index in `run_ramp`)
      """
 
     high/= 100  # Convert to mbar (fluigent units)
@@ -65,15 +66,20 @@ def make_ramp(low=0, high=0, nsteps=1, tstep=1, repeats=2,
     step = np.arange(len(p_ramp))
     stime = (1+step)*tstep 
 
-    df = pd.DataFrame(data={'step':step, 'pressure':p_ramp, 'time':stime}, index=step) # The df just feels naked without a "step" column ...*
+    ramp = {'step':step, 'pressure':p_ramp.astype(np.int32), 'time':stime.astype(np.float64)}
 
     print('---------- FLUIGENT SEQUENCE -----------')
-    print(df)
+    print(f'{"step":>6s} {"pressure":>10s} {"time":>10s}')
+    for s, p, t in zip(ramp['step'], ramp['pressure'], ramp['time']):
+        print(f'{s:6d} {p:10d} {t:10.2f}')
     print('----------------------------------------')
 
-    return df
+    if return_df:
+        import pandas as pd
+        return pd.DataFrame(data=ramp, index=step) # The df just feels naked without a "step" column ...*
+    return ramp
 
-def run_ramp(pressure_index=0, ramp=pd.DataFrame(), acq_rate=10, save_folder='.', 
+def run_ramp(pressure_index=0, ramp=None, acq_rate=10, save_folder='.', 
              switch_off_at_end=False, verbose=False, run_event=None, stop_time=None):
     """RUN_RAMP() : Runs a pressure ramp on the Fluigent controller. The function
     also records the (measured ?) pressure from the device while it tries to apply
@@ -82,55 +88,68 @@ def run_ramp(pressure_index=0, ramp=pd.DataFrame(), acq_rate=10, save_folder='.'
     ARGS
     -----
     * pressure_index [int, default 0] : the "channel" with which you want to work 
-    * ramp [pd.DataFrame, default empty df] : the ramp of pressure you want to work with.
-    You can use make_ramp to create your ramp, or just specify a df with "pressure", "time" columns.
+    * ramp [dict or pd.DataFrame] : the ramp of pressure you want to work with.
+    You can use make_ramp to create your ramp, or just specify a dict / df with "pressure", "time" columns.
     * acq_rate [float, default 5] : the number of pressure measurements you want to take per second
     * save_folder [str, default '.'] : where you want your nice 'fluigent_log.txt' to be saved
     * switch_off_at_end [bool, default False] : if you want to put p to 0 at the end of the ramp
     * verbose [bool, default False] : if you want the program to print every step in the standard output 
     """
+    # Pandas indexing is slow, so we work with plain arrays in the control loop
+    p_arr = np.asarray(ramp['pressure'])
+    t_arr = np.asarray(ramp['time'])
+    n = len(p_arr)
+
     step = 0
     acq = 0
     pmeas = 0
     timestamp = 0
-    p = ramp.iloc[0]['pressure']
+    p = p_arr[0]
     no_error = fluigent.fgt_ERROR(0) # Basically "no error"
     fgt_error = no_error
 
-    with open(save_folder + '/fluigent_log.txt', 'w') as log_file:
-        log_file.write('step,texp,tint,p_target,p_measured\n')
+    # The log file stays open during the whole ramp, and we write lines to it in batches
+    log_file = open(save_folder + '/fluigent_log.txt', 'w')
+    log_file.write('step,texp,tint,p_target,p_measured\n')
+    lines = []
 
     if stop_time == None:
-        stop_time = np.max(ramp['time'])
+        stop_time = np.max(t_arr)
 
     t0 = time.time()
-    fluigent.fgt_set_pressure(pressure_index=pressure_index, pressure=ramp.iloc[0]['pressure'])
+    fluigent.fgt_set_pressure(pressure_index=pressure_index, pressure=p)
     if verbose:
         print(f'fluigenttools.run_ramp >> Step n°{step}, p={p} mbar')
     
-    while time.time() - t0 <= stop_time and step < len(ramp):
-        t_now = time.time()
-
-        if run_event is not None and not run_event.is_set():    # If main thread has told you to die, basically
-            print('fluigenttools.run_ramp() >> Aborted.')
-            break
-
-        if t_now - t0 > ramp.iloc[step]['time'] and step < len(ramp) and t_now - t0 < stop_time:
-            step += 1
-            p = ramp.iloc[step]['pressure']
-            fgt_error = fluigent.fgt_set_pressure(pressure_index=pressure_index, pressure=p)
-            print(f'fluigenttools.run_ramp >> Step n°{step}, p={p} mbar')
-
-        if (t_now - t0)*acq_rate > acq:
-            acq += 1
-            (fgt_error, pmeas,timestamp) = fluigent.fgt_get_pressure(pressure_index=pressure_index, 
-                                                                     include_timestamp=True, get_error=True)
-            with open(save_folder + '/fluigent_log.txt', 'a') as log_file:
-                log_file.write(f'{step},{t_now},{timestamp},{100*ramp.iloc[step]["pressure"]:.2f},{100*pmeas:.2f}\n')
-
-        if fgt_error != no_error:
-            print(f'fluigenttools.run_ramp >> Channel {pressure_index} encountered {fgt_error} !')
-            break
+    try:
+        while time.time() - t0 <= stop_time and step < n:
+            t_now = time.time()
+
+            if run_event is not None and not run_event.is_set():    # If main thread has told you to die, basically
+                print('fluigenttools.run_ramp() >> Aborted.')
+                break
+
+            if t_now - t0 > t_arr[step] and step < n - 1 and t_now - t0 < stop_time:
+                step += 1
+                p = p_arr[step]
+                fgt_error = fluigent.fgt_set_pressure(pressure_index=pressure_index, pressure=p)
+                print(f'fluigenttools.run_ramp >> Step n°{step}, p={p} mbar')
+
+            if (t_now - t0)*acq_rate > acq:
+                acq += 1
+                (fgt_error, pmeas,timestamp) = fluigent.fgt_get_pressure(pressure_index=pressure_index, 
+                                                                         include_timestamp=True, get_error=True)
+                lines.append(f'{step},{t_now},{timestamp},{100*p_arr[step]:.2f},{100*pmeas:.2f}\n')
+                if len(lines) >= 64:
+                    log_file.writelines(lines)
+                    lines.clear()
+
+            if fgt_error != no_error:
+                print(f'fluigenttools.run_ramp >> Channel {pressure_index} encountered {fgt_error} !')
+                break
+    finally:
+        log_file.writelines(lines)
+        log_file.close()
         
     if switch_off_at_end:
         print(' ')
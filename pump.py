@@ -1,23 +1,37 @@
+import re
+import csv
+import math
 import serial
 import time
 import pandas as pd
 import numpy as np
 import threading
 
+# The pump answers each command with a bare '\n' followed by a message and / or a status
+_REPLY_SEP = re.compile(r'(?<!\r)\n')
+_VALID_STATUS = frozenset({':', '>', '<', '*', 'T*'})
+
+# Answers to volume / time queries, e.g. '2.28205 ul', '19.988 seconds' or '00:01:20'
+_VOL_RE = re.compile(r'([-+]?\d*\.?\d+(?:[eE][-+]?\d+)?) (ul|ml|nl)\b')
+_TIME_RE = re.compile(r'(\d*\.?\d+) seconds|(\d+):(\d+):(\d+)')
+
+# Commands we send all the time, encoded once and for all (see `Pump.write_bytes`)
+_READ_VOLUMES = b'ivolume\r\nwvolume\r\n'
+_RUN = b'run\r\n'
+_STOP = b'stop\r\n'
+
 class shared_var():
     """ A super duper simple shared variable 
-    class"""
+    class. NOTE : no lock needed, setting / getting 
+    a single attribute is atomic in Python """
     def __init__(self, val=0):
-        self.lock = threading.Lock()
         self.val = val
 
     def get(self):
-        with self.lock:
-            return self.val
+        return self.val
         
     def set(self, val=0):
-        with self.lock:
-            self.val = val
+        self.val = val
 
 class Pump():
     """ PUMP : Brice's (simplified) pump handling class
@@ -56,8 +70,9 @@ class Pump():
         self.now_volume = 0 # The net _injected_ volume irrespective of the initial volume of gas/liquid 
                             # in the syringe
         self.ini_volume = ini_volume   # The amount of gas _initially_ present in the syringe
-        self._ivol = [0,0,0,0]
-        self._wvol = [0,0,0,0]
+        self._vol = np.zeros((2,4))   # Infused (row 0) / withdrawn (row 1) volumes, see `_keep_track`
+        self._was_running = True    # So that the first `read` actually asks the pump
+        self._pending = 0           # Number of answers to `write_async` commands we have not read yet
 
         print(f'pump.__init__ >> Connecting to port {self.port} ...')
 
@@ -72,26 +87,24 @@ class Pump():
         ## Forces the "ultra" commands. At some point it had reversed on its own
         # to the "22" and "44" commands and I did not understand ANYTHING
         # anymore. So I am leaving it "just in case"...
-        self.write('cmd ultra')
-        self.write('smooth on')
+        cmds = ['cmd ultra', 'smooth on']
 
         if reset: 
-            self.write('cvolume')
-            self.write('ctime')
+            cmds += ['cvolume', 'ctime']
 
         ## Check the details of the syringe and infusion if parameters have
         # not been specified before ; otherwise apply them
-        if syringe: self.syringe = self.write(f'syrmanu {syringe}')
-        else: self.syringe = self.write(f'syrmanu')
-
-        if not diameter: self.diameter = float(self.write(f'diameter').split(' ')[0])
-        else: self.write(f'diameter {diameter} mm')
+        cmds += [f'syrmanu {syringe}' if syringe else 'syrmanu',
+                 f'diameter {diameter} mm' if diameter else 'diameter',
+                 f'svolume {svolume} ul' if svolume else 'svolume',
+                 f'irate {infuse_rate} u/m',
+                 f'wrate {withdraw_rate} u/m']
         
-        if not svolume: self.svolume = _convert_volume(self.write(f'svolume'))
-        else: self.write(f'svolume {svolume} ul')
-
-        self.write(f'irate {infuse_rate} u/m')
-        self.write(f'wrate {withdraw_rate} u/m')
+        # Everything is sent in one go, answers come back in the same order
+        syr_answer, dia_answer, svol_answer = self.write_multi(cmds)[-5:-2]
+        self.syringe = syr_answer
+        self.diameter = diameter if diameter else float(dia_answer.split(' ')[0])
+        self.svolume = svolume if svolume else _convert_volume(svol_answer)
 
         print(f'pump.__init__ > Syringe is {self.syringe} / volume {self.svolume}, diameter {self.diameter}')        
 
@@ -113,61 +126,107 @@ class Pump():
         to the "pump" object as `self.msg` and `self.status` (if message 
         was received successfully)
         """
-        valid_status = set([':', '>', '<', '*', ':', 'T*'])
-        message = ''
-        out = b''
-        status = self.status
+        return self.write_multi([cmd], timeout=timeout, verbose=verbose)[0]
+
+    def write_multi(self, cmds:list, timeout=2, verbose=False) -> list:
+        """ Same as `write`, but sends a list of commands in one go and 
+        reads all the answers at once (so we only wait once for the pump)
+
+        ARGS
+        -----
+        * cmds (list of strings) : the commands you want to run
+        * timeout (float, in seconds) : when to give up with the commands
+        * verbose (bool, default False) : if you want to display each raw message received 
+
+        RETURNS
+        ------
+        * msgs (list of strings) : the **processed** answers from the pump, one per command.
+        NOTE : `self.msg` and `self.status` are the ones of the last command
+        """
+        raw = ''.join([c + '\r\n' for c in cmds]).encode()
+        return self.write_bytes(raw, n=len(cmds), timeout=timeout, verbose=verbose)
+
+    def write_bytes(self, raw:bytes, n=1, timeout=2, verbose=False) -> list:
+        """ The fast lane of `write_multi` for commands we send all the time : 
+        `raw` is `n` commands already encoded, each ending with '\\r\\n' (see `_READ_VOLUMES`, ...) 
+
+        RETURNS
+        ------
+        * msgs (list of strings) : the **processed** answers from the pump, one per command.
+        """
+        # Anything already there is a late answer to an exchange that timed out, it is not ours. 
+        # (unless we are waiting for answers to `write_async` commands)
+        if self._pending == 0 and self.ser.in_waiting:
+            self.ser.reset_input_buffer()
 
-        # Send command
-        cmd = cmd + '\r\n'
+        # Send commands (no need to flush, we wait for the answer anyway)
         try:
-            self.ser.write(cmd.encode())
-            self.ser.flush()
+            self.ser.write(raw)
         except serial.SerialTimeoutException:
             print(f'pumptools.PhDUltraPump.write >> Sending message timed out')
         
-        # Wait for reply to arrive
+        # Answers to previous `write_async` commands come first, we skip them
+        n_wait, self._pending = n + self._pending, 0
+        out = self._read_reply(n=n_wait, timeout=timeout)
+
+        if verbose:
+            print(f'pumptools.PhDUltraPump.write >> Raw sent : {raw}, Received raw : "{out}"')
+
+        return self._parse_reply(out, n_wait)[-n:]
+
+    def write_async(self, cmd) -> None:
+        """ Sends a command (str, or bytes like `write_bytes`) without waiting for the answer. 
+        Good for commands we do not care about the answer of (e.g. `run`). 
+        NOTE : the answer is read (and thrown away) by the next `write`, so `self.status` 
+        is only updated then """
+        raw = cmd if isinstance(cmd, bytes) else (cmd + '\r\n').encode()
+        try:
+            self.ser.write(raw)
+            self._pending += 1
+        except serial.SerialTimeoutException:
+            print(f'pumptools.PhDUltraPump.write_async >> Sending message timed out')
+
+    def _read_reply(self, n=1, timeout=2) -> bytes:
+        """ Waits for the `n` answers of the pump to arrive and returns them (raw).
+        Reads are blocking, so we get back as soon as the last status arrives """
+        out = b''
         t0 = time.time()
-        has_timed_out = False
-        old_bytes_received = -1
-        new_bytes_received = 0
-
-        while old_bytes_received != new_bytes_received and not has_timed_out:
-            old_bytes_received = new_bytes_received
-            new_bytes_received = self.ser.in_waiting
-            has_timed_out = time.time() - t0 > timeout 
-            time.sleep(0.05)
+        while not _is_complete(out, n) and time.time() - t0 < timeout:
+            out += self.ser.read(max(1, self.ser.in_waiting))   # Blocks until something comes (or serial timeout)
         
-        out = self.ser.read_all()
-        parts = []
+        return out
+
+    def _parse_reply(self, out:bytes, n=1) -> list:
+        """ Splits the raw answer `out` of the pump to `n` commands into 
+        `n` (processed) messages, and updates `self.status` and `self.msg`.
+
+        Each answer starts with a bare '\n' and ends with a status, e.g. b'\n2.28205 ul\r\n<'.
+        Weird cases we know of : b'\n19.988 seconds\r\n>\r\nT*' (two statuses) 
+        and b'\r\nT*\n10.0011 ul\r\nT*' (leftover status from before our command) """
+        
+        messages = ['']*n
+        status = self.status
+        chunks = []
         if out is not None:
-            parts = out.decode().split('\n') # This separates actual lines
-            parts = list(map(lambda str: str.strip('\r'), parts))
+            chunks = _REPLY_SEP.split(out.decode())[1:]   # Anything before the first answer is a leftover
 
-        if verbose:
-            print(f'pumptools.PhDUltraPump.write >> Raw sent : {cmd.encode()}, Received raw : "{out}"')
-            
-        if len(parts) >= 3: 
-            status = parts[-1] 
-            if parts[-2] in valid_status:  # Weird Case no1 : e.g. b'\n19.988 seconds\r\n>\r\nT*'
-                message = parts[1]
-            else:                          # Weird Case no2 : e.g. b'\r\nT*\n10.0011 ul\r\nT*' or normal case, e.g. b'\n2.28205 ul\r\n<'   
-                message = parts[-2]         
-        if len(parts) == 2: 
-            message = ''
-            status = parts[1].strip('\n')
-        elif len(parts) <= 1:
+        if len(chunks) < n:
             print(f'pumptools.PhDUltraPump.write >> Warning : received raw message "{out}" and I cannot understand it')
+
+        for no, chunk in enumerate(chunks[-n:]):
+            lines = chunk.splitlines() or ['']
+            status = lines[-1]
+            messages[no] = next((line for line in reversed(lines[:-1]) if line not in _VALID_STATUS), '')
         
         # Update pump object and return message because we are nice
-        if status in valid_status:
+        if status in _VALID_STATUS:
             self.status = status
         else: 
             print(f'pumptools.PhDUltraPump.write >> Warning : Odd status {status} from message {out} ... maybe a fluke. Ignoring it for now ...')
-        self.msg = message
-        return message
+        self.msg = messages[-1]
+        return messages
 
-    def write_safe(self, cmd:str, timeout=2, verbose=False) -> None:
+    def write_safe(self, cmd:str, timeout=2, verbose=False, max_retries=4) -> None:
         """ A wrapper on "pump.write" that checks more thoroughly
         __what__ the syringe pump answers you when you want to do things
         (sometimes it gets your orders wrong). Works mostly with "load XXXX" 
@@ -179,6 +238,7 @@ class Pump():
         * cmd (string) : the command you want to run , __with parameters__ (e.g. tvolume : 1 ul)
         * timeout (float, in seconds) : when to give up with a command
         * verbose (bool) : ask whether you want a 
+        * max_retries (int, default 4) : how many times we ask the pump again before giving up
 
         RETURNS
         -----
@@ -206,10 +266,12 @@ class Pump():
         _ = self.write(cmd, timeout=timeout, verbose=verbose)
         answer = self.write(base_command, timeout=timeout, verbose=verbose)
         t0 = time.time()
-        while answer != expected_answer and time.time() - t0 < timeout:
-            answer = self.write(base_command, timeout=timeout)
+        retries = 0
+        while answer != expected_answer and time.time() - t0 < timeout and retries < max_retries:
+            answer = self.write(base_command, timeout=timeout)   # No need to wait in between, `write` waits for the answer
+            retries += 1
+        if answer != expected_answer:
             print(f'pumptools.PhDUltraPump.write_safe >> sent "{cmd}" then "{base_command}" and  received "{answer}" instead of "{expected_answer}"')
-            time.sleep(0.25)
 
     def start(self, mode='infuse', reset=True, tvolume=None, rate=None, quiet=False) -> None:
         """ Starts the pump. Default `mode` is infusing.
@@ -246,12 +308,12 @@ class Pump():
                     self.write_safe(f'{rate_word} {rate} u/m')
             
             self.write_safe(f'load {mode}')
-            self.write('run')
+            self.write_bytes(_RUN)
             
     def stop(self, quiet=False) -> None:
         """ STOP() : Stops the pump. D'uh. """
         if not quiet: print(f'pump.stop > Stopped')
-        self.write('stop') 
+        self.write_bytes(_STOP)
 
     def read(self) -> None:
         """ READ : Read the current values of : 
@@ -260,18 +322,27 @@ class Pump():
          while the pump is running ! 
          It updates the `now_volume` which basically keeps track of the 
           **TOTAL INJECTED VOLUME** (so injection means + )
+         NOTE : when the pump has been idle since the last read, volumes are zero 
+         anyway, so we do not bother asking the pump
          """
         
-        self._ivol[0] = _convert_volume(self.write('ivolume'))
-        self._wvol[0] = _convert_volume(self.write('wvolume'))
-        self._ivol = _keep_track(self._ivol)
-        self._wvol = _keep_track(self._wvol)
-        self.now_volume = (self._ivol[3]-self._wvol[3])
+        running = self.status in ('>', '<')
+        if running or self._was_running or self._pending:     # NOTE : after `write_async`, our status may be outdated
+            ivol, wvol = self.write_bytes(_READ_VOLUMES, n=2)
+            self._vol[0,0] = _convert_volume(ivol)
+            self._vol[1,0] = _convert_volume(wvol)
+        else:
+            self._vol[:,0] = 0
+        self._was_running = running
+        _keep_track(self._vol[0])
+        _keep_track(self._vol[1])
+        self.now_volume = self._vol[0,3] - self._vol[1,3]
 
 
     def close(self) -> None:
         """ CLOSE() : Stops the pump and closes the connection """
         self.stop()
+        self.ser.flush()
         self.ser.close()
 
 def run_sequence(pump:Pump, sequence:pd.DataFrame, save_folder='.', run_event=None, quiet=False):
@@ -295,41 +366,61 @@ def run_sequence(pump:Pump, sequence:pd.DataFrame, save_folder='.', run_event=No
 
     headerstr = f'{"step":5s}\t{"texp":8s}\t{"cycle":5s}\t{"rep":5s}\t{"volum":8s}\t{"status":6s}'
     if not quiet: print(headerstr)
-    with open(save_folder + '/pump_log.txt', 'w') as logfile:
-        logfile.write(headerstr.replace('\t', ',') + '\n')
-
-    t0 = time.time()
-    for no, step in sequence.iterrows():
-        t_seq = time.time()
-        stay_in_step = True
 
-        if step['type'] != '0': 
-            pump.start(reset=False, mode=step['type'], rate=step['rate'], tvolume=step['volume'], quiet=True)
-        elif pump.status not in ('T*','*',':'): # If step['type'] == '0', normally we should already have stopped, but we still do it in case we have issues.
-            pump.stop(quiet=False)
-
-        while stay_in_step:
-            if step['type'] != '0':
-                stay_in_step = (pump.status != 'T*') and (time.time() - t_seq <= step['duration']*1.25)        # If we stay in the step too long, there must be an issue ...
-            else:
-                stay_in_step = (time.time() - t_seq <= step['duration'] + 0.5)
-
-            pump.read()
+    # The log file stays open during the whole sequence, and we write rows to it in batches of 16
+    logfile = open(save_folder + '/pump_log.txt', 'w', newline='')
+    logwriter = csv.writer(logfile, lineterminator='\n')
+    logwriter.writerow(['step', 'texp', 'cycle', 'rep', 'volum', 'status', 'time'])
+    rows = []
 
-            datastr = f'{no:5d}\t{time.time()-t0:8.2f}\t{step["cycle"]:5d}\t{step["repeat"]:5d}\t{pump.now_volume:8.2f}\t{pump.status:6s}\t{step["time"]}'
-            if not quiet: print(datastr)
-            with open(save_folder + '/pump_log.txt', 'a') as logfile:
-                logfile.write(datastr.replace('\t', ',') + '\n')
+    try:
+        # Pandas rows are slow to build / index, so we loop on plain arrays
+        types, rates, vols = sequence['type'].to_numpy(), sequence['rate'].to_numpy(), sequence['volume'].to_numpy()
+        durs, cycs, reps = sequence['duration'].to_numpy(), sequence['cycle'].to_numpy(), sequence['repeat'].to_numpy()
+        times = sequence['time'].to_numpy()
+
+        # Log lines on screen are built from a template
+        tab_fmt = '{:5d}\t{:8.2f}\t{:5d}\t{:5d}\t{:8.2f}\t{:6s}\t{}'.format
+
+        t0 = time.perf_counter()
+        for no in range(len(types)):
+            t_seq = time.perf_counter()
+            stay_in_step = True
+
+            if types[no] != '0': 
+                pump.start(reset=False, mode=types[no], rate=rates[no], tvolume=vols[no], quiet=True)
+            elif pump.status not in ('T*','*',':'): # If step['type'] == '0', normally we should already have stopped, but we still do it in case we have issues.
+                pump.stop(quiet=False)
+
+            while stay_in_step:
+                t_now = time.perf_counter()     # We only look at the clock once per tick
+                if types[no] != '0':
+                    stay_in_step = (pump.status != 'T*') and (t_now - t_seq <= durs[no]*1.25)        # If we stay in the step too long, there must be an issue ...
+                else:
+                    stay_in_step = (t_now - t_seq <= durs[no] + 0.5)
+
+                pump.read()
+
+                data = (no, round(t_now-t0, 2), cycs[no], reps[no], round(pump.now_volume, 2), pump.status, times[no])
+                if not quiet: print(tab_fmt(*data))
+                rows.append(data)
+                if len(rows) >= 16:
+                    logwriter.writerows(rows)
+                    rows.clear()
             
-            if pump.status == '*':
-                print('pump.run_sequence > Motor Stalled.')
+                if pump.status == '*':
+                    print('pump.run_sequence > Motor Stalled.')
 
-            if run_event is not None and not run_event.is_set(): # Kill immediately if term signal sent
-                pump.stop()
-                print('pump.run_sequence > Aborted.')
-                return 0
+                if run_event is not None and not run_event.is_set(): # Kill immediately if term signal sent
+                    pump.stop()
+                    print('pump.run_sequence > Aborted.')
+                    return 0
             
-            time.sleep(0.25)
+                _sleep(0.25, run_event)
+
+    finally:
+        logwriter.writerows(rows)
+        logfile.close()
                     
     print('pump.run_sequence > Run Complete.')
     return 0
@@ -357,7 +448,7 @@ def regulate(pump:Pump, p_measure:shared_var, p_target:float,
     * quiet [default False] : remove standard output
     """
 
-    t0 = time.time() 
+    t0 = time.perf_counter() 
     pump.write(f'cvolume')
     pump.write(f'irate {rate} u/m')
     pump.write(f'wrate {rate} u/m') 
@@ -366,11 +457,19 @@ def regulate(pump:Pump, p_measure:shared_var, p_target:float,
 
     headerstr = f'{"time":8s}\t{"pmeas":8s}\t{"ptarg":8s}\t{"status":6s}\t{"injvol":8s}\t{"syrvol":8s}\t{"gorev"}\t{"gofwd"}\t{"syrend"}'
     if not quiet: print(headerstr)
-    with open(save_folder + '/pump_log.txt', 'w') as logfile:
-        logfile.write(headerstr.replace('\t', ',') + '\n')
+
+    # The log file stays open during the whole regulation, and we write rows to it in batches of 16
+    logfile = open(save_folder + '/pump_log.txt', 'w', newline='')
+    logwriter = csv.writer(logfile, lineterminator='\n')
+    logwriter.writerow(['time', 'pmeas', 'ptarg', 'status', 'injvol', 'syrvol', 'gorev', 'gofwd', 'syrend'])
+    rows = []
+
+    # Log lines on screen are built from a template
+    tab_fmt = '{:8.2f}\t{:8.1f}\t{:8.1f}\t{:6s}\t{:+8.2f}\t{:+8.2f}\t{}\t{}\t{}'.format
     
+    t_now = 0
     try:
-        while time.time() - t0 < max_time:
+        while t_now < max_time:
 
             # Abort if something happens
             if abort_thread is not None and not abort_thread.is_set():
@@ -384,10 +483,11 @@ def regulate(pump:Pump, p_measure:shared_var, p_target:float,
             
             # Decide what to do based on inputs
             pnow = p_measure.get()
-            stop_incr  = np.isfinite(pnow) and (pnow >= p_target)
-            start_incr  = np.isfinite(pnow) and (pnow < (1-relative_tolerance)*p_target - absolute_tolerance/2)
-            start_decr = np.isfinite(pnow) and (pnow > (1+relative_tolerance)*p_target + absolute_tolerance/2)
-            stop_decr = np.isfinite(pnow) and (pnow <= p_target)
+            p_valid = math.isfinite(pnow)   # No need for numpy on a single float
+            stop_incr  = p_valid and (pnow >= p_target)
+            start_incr  = p_valid and (pnow < (1-relative_tolerance)*p_target - absolute_tolerance/2)
+            start_decr = p_valid and (pnow > (1+relative_tolerance)*p_target + absolute_tolerance/2)
+            stop_decr = p_valid and (pnow <= p_target)
 
             syrvol = pump.ini_volume - pump.now_volume
             syr_end  = (syrvol < 0.02*pump.svolume) or (syrvol > 0.98*pump.svolume)
@@ -410,30 +510,56 @@ def regulate(pump:Pump, p_measure:shared_var, p_target:float,
                     or syr_end
                 go_fwd, go_rev = go_rev, go_fwd
 
-            if go_fwd:
-                pump.write('load qs i')
-                pump.write('run')
+            if go_fwd:      # No need to wait for the answers, the next `pump.read()` gets them
+                pump.write_async('load qs i')
+                pump.write_async(_RUN)
             if go_rev:
-                pump.write('load qs w')
-                pump.write('run')
+                pump.write_async('load qs w')
+                pump.write_async(_RUN)
             elif stop:
                 pump.stop(quiet=True)
 
-            time.sleep(0.33)
+            _sleep(0.33, abort_thread)
 
-            datastr = f'{time.time()-t0 :8.2f}\t{pnow:8.1f}\t{p_target:8.1f}\t{pump.status:6s}\t{pump.now_volume:+8.2f}\t{syrvol:+8.2f}\t{go_rev}\t{go_fwd}\t{syr_end}'
-            if not quiet: print(datastr)
-            with open(save_folder + '/pump_log.txt', 'a') as logfile:
-                logfile.write(datastr.replace('\t', ',') + '\n')                 
+            t_now = time.perf_counter() - t0     # We only look at the clock once per tick
+            data = (round(t_now, 2), round(pnow, 1), round(p_target, 1), pump.status, 
+                    round(pump.now_volume, 2), round(syrvol, 2), go_rev, go_fwd, syr_end)
+            if not quiet: print(tab_fmt(*data))
+            rows.append(data)
+            if len(rows) >= 16:
+                logwriter.writerows(rows)
+                rows.clear()
     finally:
         pump.stop(quiet=True)
+        logwriter.writerows(rows)
+        logfile.close()
     
 ############################################################################################
 ### UTILITY FUNCTIONS .... #################################################################
 
-def _keep_track(vals:list):
+def _sleep(dt:float, run_event=None):
+    """ Sleeps for `dt` seconds, but wakes up early (within 50 ms) if 
+    `run_event` gets cleared, i.e. if the main thread wants us to stop """
+    if run_event is None:
+        time.sleep(dt)
+        return
+    t_end = time.time() + dt
+    while run_event.is_set():
+        t_left = t_end - time.time()
+        if t_left <= 0:
+            break
+        time.sleep(min(t_left, 0.05))
+
+def _is_complete(out:bytes, n=1) -> bool:
+    """ Checks whether the raw answer `out` of the pump contains `n` answers, 
+    the last one ending with a status """
+    chunks = _REPLY_SEP.split(out.decode())[1:]
+    return len(chunks) >= n and chunks[-1].split('\r\n')[-1] in _VALID_STATUS
+
+def _keep_track(vals:np.ndarray):
     """ Keeps track of the syringe volume by doing operations
     on the withdrawn / injected volumes as a function of time.
+    NOTE : `vals` is modified in place
 
     0 : current (raw) reading
     1 : previous (raw) reading
@@ -457,35 +583,27 @@ def _convert_time(time_str : str) -> float:
     """ Converts the time str sent by
         the pump into a useful float in s
     """
-    time_str = time_str.replace('\r', '')
-    try:
-        if 'seconds' in time_str:
-            tval = float(time_str.split(' ')[0])
-        elif ':' in time_str:
-            hh, mm, ss = time_str.split(':')
-            tval = int(hh)*3600 + int(mm)*60 + int(ss)
-        else:
-            print(f'{time_str} ??' )
-            tval = np.nan
-        return tval
-    except ValueError:
+    match = _TIME_RE.search(time_str)
+    if match is None:
+        print(f'{time_str} ??' )
         return np.nan
+    if match.group(1) is not None:      # e.g. '19.988 seconds'
+        return float(match.group(1))
+    hh, mm, ss = match.group(2, 3, 4)   # e.g. '00:01:20'
+    return int(hh)*3600 + int(mm)*60 + int(ss)
 
 def _convert_volume(volume_str : str) -> float:
     """ Converts the volume str sent by the pump
      into a useful volume float in µl """
-    volume_str = volume_str.replace('\r', '')
-    if 'ul' in volume_str or 'ml' in volume_str or 'nl' in volume_str:
-        volume_str = volume_str.lstrip('T*') # If target volume reached, it adds T* to the string ...
-        vval, vunit = volume_str.split(' ')
-        vval = float(vval)
-        if vunit == 'ml':
-            vval = vval*1000
-        elif vunit == 'nl':
-            vval = vval/1000
-        return vval
-    else: 
+    match = _VOL_RE.search(volume_str)  # NOTE : if target volume reached, it adds T* to the string, the regex skips it
+    if match is None:
         return np.nan
+    vval, vunit = float(match.group(1)), match.group(2)
+    if vunit == 'ml':
+        vval = vval*1000
+    elif vunit == 'nl':
+        vval = vval/1000
+    return vval
 
 def make_sequence(volume=[0], rate=[1], duration=[1], repeat=[1], cycle_kind='i0w0', center=False):
     """ A routine that creates your sequence for you. 
@@ -512,31 +630,24 @@ def make_sequence(volume=[0], rate=[1], duration=[1], repeat=[1], cycle_kind='i0
         raise ValueError
     
     n_in_cycle = len(cycle_kind)
-    n_steps = n_in_cycle*np.sum(repeat)        # Should give us the correct number of steps
+    per_cyc = n_in_cycle*np.asarray(repeat)     # Number of steps of each cycle
+    n_steps = np.sum(per_cyc)                   # Should give us the correct number of steps
+    starts = np.cumsum(per_cyc) - per_cyc       # First step of each cycle
     step_list = np.arange(0, n_steps).astype(int)
-    step_vol  = []
-    step_rate = []
-    step_dur = []
-    step_type = []
-    step_cycle = []
-    step_repeat = []
 
     # Creating list of steps
-    for cyc_no in range(nvols):
-        step_type.extend(list(cycle_kind)*repeat[cyc_no])
-        step_rate.extend([rate[cyc_no]]*n_in_cycle*repeat[cyc_no])
-        step_dur.extend([duration[cyc_no]]*n_in_cycle*repeat[cyc_no])
-        step_cycle.extend([cyc_no]*n_in_cycle*repeat[cyc_no])
-        step_repeat.extend(np.repeat(np.arange(0,repeat[cyc_no]).astype(int), repeats=len(cycle_kind)))
-
-        if not center or (cycle_kind != 'i0w0' and cycle_kind != 'w0i0'): # Basically if we do not ask to center or if we have an "uncentered" cycle (i.e. not a cycle)
-            step_vol.extend([volume[cyc_no]]*n_in_cycle*repeat[cyc_no])
-        else:
-            v_half, v_full = volume[cyc_no]/2, volume[cyc_no]
-            v_list = [v_full]*n_in_cycle*repeat[cyc_no]
-            v_list[0] = v_half
-            v_list[-2] = v_half
-            step_vol.extend(v_list)
+    step_type = np.tile(list(cycle_kind), np.sum(repeat))
+    step_rate = np.repeat(rate, per_cyc)
+    step_dur = np.repeat(np.asarray(duration, dtype=float), per_cyc)   # Durations of i / w steps are recomputed (as floats) below
+    step_cycle = np.repeat(np.arange(nvols), per_cyc)
+    step_repeat = (step_list - np.repeat(starts, per_cyc)) // n_in_cycle
+    step_vol = np.repeat(volume, per_cyc)
+
+    if center and (cycle_kind == 'i0w0' or cycle_kind == 'w0i0'): # Basically if we ask to center a "centered" cycle (i.e. an actual cycle)
+        starts, ends = starts[per_cyc > 0], (starts + per_cyc)[per_cyc > 0]
+        step_vol = step_vol.astype(float)
+        step_vol[starts] /= 2
+        step_vol[ends-2] /= 2
     
     sequence = pd.DataFrame(data={'cycle': step_cycle, 'repeat': step_repeat,
                                   'type':step_type, 'volume':step_vol, 'rate':step_rate,  
@@ -562,17 +673,19 @@ def advanced_test(port='COM3', reverse=False):
 
     def fake_pressure_signal(p_measure:shared_var, max_time=50):
         import keyboard
-        t0 = time.time()   
-        print('Press +/- to increase/decrease pressure')
-        while time.time() - t0 < max_time:
-            pnow = p_measure.get()
 
-            if keyboard.read_key() == "+":
-                p_measure.set(pnow + 1)
-                time.sleep(0.1)   
-            elif keyboard.read_key() == '-':
-                p_measure.set(pnow - 1)
-                time.sleep(0.1)
+        def on_key(event):
+            if event.name == '+':
+                p_measure.set(p_measure.get() + 1)
+            elif event.name == '-':
+                p_measure.set(p_measure.get() - 1)
+
+        print('Press +/- to increase/decrease pressure')
+        hook = keyboard.on_press(on_key)
+        try:
+            time.sleep(max_time)    # Key presses are dealt with by `on_key` in the meantime
+        finally:
+            keyboard.unhook(hook)
         return 0 
 
     p_measure = shared_var(0.0)
@@ -13,7 +13,10 @@ Created on Wed Jun  7 18:29:00 2023
 import serial
 import time
 import numpy as np
-    
+
+# Pressure sensor type -> slope of Vmeas/Vs vs. p (in kPa), see `read_buffer`
+_FACTORS = {'5010': 0.09, '5100': 0.009}
+
 class Sensor():
     """ A class to manage the Pressure and the Humidity sensors
     through the ARDUINO board. 
@@ -34,15 +37,18 @@ class Sensor():
 
     def __init__(self, port='COM4', baudrate=115200, ptype='5010'):
 
+        self.ptype = str(ptype)
+        if self.ptype not in _FACTORS:
+            raise ValueError(f'Sensor type {self.ptype} not implemented !')
+        self._factor = _FACTORS[self.ptype]
         self.port = port
         self.baudrate = baudrate
         self.ser = serial.Serial(port=self.port, baudrate=self.baudrate, timeout=2)
-        self.p = []
-        self.ptype = ptype
-        self.tlocal = []
-        self.texp = []
-        self.hum = []
-        self.temp = []
+        self.t0 = time.monotonic()          # `texp` is measured with the monotonic clock (so no surprises) ...
+        self.t0_epoch = time.time()         # ... but starting from the epoch time, to line up with the other logs
+        self._buf = np.empty((1024, 5))     # All measurements (texp, tlocal, p, hum, temp), grows when needed
+        self._n = 0                         # Number of measurements in there
+        self._rest = b''                    # Incomplete line left over from the last read
     
         try:
             self.ser.open()
@@ -56,66 +62,59 @@ class Sensor():
         """ A basic function to read all the contents of 
         the serial port corresponding to the pressure/humidity
         sensor """
-         # Wait for reply to arrive
-        t0 = time.time()
-        has_timed_out = False
-        old_bytes_received = -1
-        new_bytes_received = 0
-
-        while old_bytes_received != new_bytes_received and not has_timed_out:
-            old_bytes_received = new_bytes_received
-            new_bytes_received = self.ser.in_waiting
-            has_timed_out = time.time() - t0 > timeout 
-            time.sleep(0.05)
-        
-        if not has_timed_out:
-            out = self.ser.read_all()
-            if out is not None:
-                out = out.decode().strip()
-            else:
-                return 0
-            if verbose:
-                print(f'Sensor >> read_one ; received "{out}"')
-            if len(out) > 0:
-                out = out.split('\r\n')
-                n_lines = 0
-                
-                for line in out:
-                    try: 
-                        parts = line.split(' ')
-                        tlocal = float(parts[0])
-                        hum = float(parts[2])
-                        temp = float(parts[3])
-                        
-                        # Pressure reading V -> Pa
-                        factor = np.nan
-                        vnormed = float(parts[1]) # Vnormed is actually Vmeas/Vs in the doc
-                        if self.ptype == '5010': factor = 0.09
-                        elif self.ptype == '5100': factor = 0.009
-                        else: raise ValueError('Sensor type {self.ptype} not implemented !')
-
-                        p = (vnormed-0.04)/factor*1e3
-                            # Official formula is : Vmeas/Vs = p x 0.09  + 0.04 for 5010
-                            #                       Vmeas/Vs = p x 0.009 + 0.04 for 5100
-                            # My vnormed is between 0 and 1 (== Vmeas/Vs)
-                        
-                        self.texp.append(float(time.time()))
-                        self.tlocal.append(tlocal)
-                        self.p.append(p)
-                        self.hum.append(hum)
-                        self.temp.append(temp)
-                        n_lines += 1
-                        
-                    except IndexError: # Basically incomplete or malformed line
-                        pass
-                    except ValueError:
-                        pass
-                return n_lines
-            else:
+        # Block (in the OS, no polling) until at least a full line has arrived, then take whatever else 
+        # is already there. An incomplete last line is kept for the next call.
+        self.ser.timeout = timeout
+        out = self._rest + self.ser.read_until(b'\n')
+        out += self.ser.read(self.ser.in_waiting)
+        end = out.rfind(b'\n') + 1
+        out, self._rest = out[:end], out[end:]
+        if verbose:
+            print(f'Sensor >> read_one ; received "{out.decode(errors="replace").strip()}"')
+
+        # Lines are 'tlocal vnormed hum temp'. Lines that are too short are dropped here, and the ones
+        # with non-numbers in them below, so that genfromtxt never has to warn us about anything
+        lines = [b' '.join(fields[:4]) for fields in map(bytes.split, out.splitlines()) if len(fields) >= 4]
+        if len(lines) > 0:
+            data = np.genfromtxt(lines, ndmin=2)
+            data = data[np.isfinite(data).all(axis=1)]
+            if data.size == 0:
                 return 0
-        else: # Timeout...
+
+            # Pressure reading V -> Pa
+            p = (data[:,1]-0.04)/self._factor*1e3
+                # Official formula is : Vmeas/Vs = p x 0.09  + 0.04 for 5010
+                #                       Vmeas/Vs = p x 0.009 + 0.04 for 5100
+                # My vnormed is between 0 and 1 (== Vmeas/Vs)
+            
+            n_lines = len(data)
+            self._append(np.column_stack((np.full(n_lines, self.t0_epoch + time.monotonic() - self.t0), data[:,0], p, data[:,2], data[:,3])))
+            return n_lines
+        else:
             return 0
 
+    def _append(self, rows:np.ndarray):
+        """ Adds rows of (texp, tlocal, p, hum, temp) at the end of our measurements """
+        n_new = self._n + len(rows)
+        if n_new > len(self._buf):      # Out of space : double the size
+            buf = np.empty((max(2*len(self._buf), n_new), 5))
+            buf[:self._n] = self._buf[:self._n]
+            self._buf = buf
+        self._buf[self._n:n_new] = rows
+        self._n = n_new
+
+    # The measurements, as (read-only) arrays
+    @property
+    def texp(self): return self._buf[:self._n, 0]
+    @property
+    def tlocal(self): return self._buf[:self._n, 1]
+    @property
+    def p(self): return self._buf[:self._n, 2]
+    @property
+    def hum(self): return self._buf[:self._n, 3]
+    @property
+    def temp(self): return self._buf[:self._n, 4]
+
     def close(self):
         """ CLOSE() : Stops the sensor and closes the connection """
         self.ser.close()
@@ -125,28 +124,27 @@ def acquire(sensor:Sensor, save_folder='.', max_time=10, rate=4, verbose=False,
     has elapsed. The 'rate' will be only roughly followed. If you want to interrupt 
     your acquisition midway, use a run_event object (from threading)
     """
-    t_ini, t_now = time.time(), time.time()
+    t_ini = t_now = time.monotonic()
+    # The log stays open during the whole acquisition (flushed after each batch of lines)
     with open(save_folder + '/sensor_log.txt', 'w') as logfile:
-        logfile.write('texp,tlocal,p1,p2,hum,temp\n')
-
-    while t_now - t_ini <= max_time:
-        if run_event is not None and not run_event.is_set():    # If main thread has told you to die, basically
-            print('sensortools.acquire() >>  Aborted.')
-            break
-        t_now = time.time()
-        nlines = sensor.read_buffer(verbose=verbose)
-        dat_str = ''
-        for idx in range(-nlines, 0):
-            dat_str += f'{sensor.texp[idx]:.2f},{sensor.tlocal[idx]:.2f},{sensor.p1[idx]:.2f},{sensor.p2[idx]:.2f},{sensor.hum[idx]:.2f},{sensor.temp[idx]:.2f}\n'
-        with open(save_folder + '/sensor_log.txt', 'a') as logfile:
-            logfile.write(dat_str)
-            
-        time.sleep(1/rate)
+        logfile.write('texp,tlocal,p,hum,temp\n')
+
+        while t_now - t_ini <= max_time:
+            if run_event is not None and not run_event.is_set():    # If main thread has told you to die, basically
+                print('sensortools.acquire() >>  Aborted.')
+                break
+            t_now = time.monotonic()
+            nlines = sensor.read_buffer(verbose=verbose)
+            if nlines:
+                np.savetxt(logfile, sensor._buf[sensor._n-nlines:sensor._n], fmt='%.2f', delimiter=',')
+                logfile.flush()
+                
+            time.sleep(1/rate)
     return 0
 
 ############# Quick test ##############################
 #######################################################
 
 if __name__ == '__main__':
-    mysensor = Sensor(port='COM4', ptype=5010)
+    mysensor = Sensor(port='COM4', ptype='5010')
     acquire(mysensor, max_time=20, rate=3)
\ No newline at end of file
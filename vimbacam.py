@@ -5,70 +5,123 @@ import time
 import queue
 import cv2
 import threading
+from functools import lru_cache
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from vmbpy import *
-from PIL import Image
 import numpy as np
-from skimage.filters import laplace
 
-to_rgb = {PixelFormat.Mono8:cv2.COLOR_GRAY2RGB, 
-          PixelFormat.Bgr8:cv2.COLOR_BGR2RGB}
+try:        # Numba is optional, it makes `get_imgprops` much faster though
+    import numba
+    _NUMBA_THREADS = min(4, numba.config.NUMBA_NUM_THREADS)     # Leave some cores to the acquisition / saving threads
+except ImportError:
+    numba = None
 
 class save:
     """ A simple class to instruct the camera to acquire images ; 
     the camera can then let the object know that the image has been
     acquired """
-    def __init__(self, t=None, t0=time.time()):
+    def __init__(self, t=None, t0=None):
         self.lock = threading.Lock()
-        self.save = False
-        self.t0 = t0
+        self._trigger = threading.Event()     # Set when an image has to be saved
+        self._last_due = -1                   # Index of the last time of `t` that has passed (see `check_time`)
+        self.t0 = time.monotonic() if t0 is None else t0    # NOTE : times are taken from the monotonic clock
         self.t = t
         self.index = 0
 
-    def set_t0(self, t0=time.time()):
+    def set_t0(self, t0=None):
         with self.lock:
-            self.t0 = t0
+            self.t0 = time.monotonic() if t0 is None else t0
 
     def check_time(self):
+        """ Triggers a save if (at least) the next time in `t` has passed. If we are late and 
+        several have passed, they are all consumed by that one save """
         if self.t is not None:
-            if time.time() - self.t0 > self.t[self.index]:
+            idx = np.searchsorted(self.t, time.monotonic() - self.t0, side='right')
+            if idx > self.index:
+                self._last_due = idx - 1
                 self.set_trigger()
 
+    @property
+    def save(self):
+        """ Kept so that `extsave.save = True` still works """
+        return self._trigger.is_set()
+
+    @save.setter
+    def save(self, value):
+        if value:
+            self._trigger.set()
+        else:
+            self._trigger.clear()
+
     def set_trigger(self):
-        with self.lock:
-            self.save = True
+        self._trigger.set()
 
     def get_trigger(self):
-        return self.save
+        return self._trigger.is_set()
     
     def complete(self):
-        with self.lock:
-            self.save = False
-            self.index += 1
+        self._trigger.clear()
+        self.index = max(self.index, self._last_due) + 1     # Only touched by the camera thread
 
     def get_index(self):
         return self.index
 
 class Handler:
-    """ # A class needed to deal with the image stream (using a `Queue`) """
+    """ # A class needed to deal with the image stream. We only ever want 
+    the latest frame, so it is kept in a single slot (with a `Lock` and an `Event`) """
     def __init__(self):
-        self.display_queue = queue.Queue(1)
+        self._latest = None
+        self._lock = threading.Lock()
+        self._new = threading.Event()
         self.timestamp = -1
 
     def get_image(self):
-        return self.display_queue.get(True)
+        self._new.wait()
+        with self._lock:
+            img = self._latest
+            self._new.clear()
+        return img
     
     def get_timestamp(self):
         return self.timestamp
 
     def __call__(self, cam: Camera, stream: Stream, frame: Frame):
         if frame.get_status() == FrameStatus.Complete:
-            self.timestamp = frame.get_timestamp()
-            self.display_queue.put(frame.as_opencv_image(), True)
+            with self._lock:
+                self.timestamp = frame.get_timestamp()
+                self._latest = frame.as_opencv_image().copy()     # The frame buffer goes back to the camera right below
+                self._new.set()
         
         cam.queue_frame(frame)
 
 
+if numba is not None:
+    # Compiled for 8 bit and 16 bit (Mono12 / Mono16) images straight from the camera
+    @numba.njit(['UniTuple(float64, 2)(uint8[:,:], int64, int64, int64, int64)',
+                 'UniTuple(float64, 2)(uint16[:,:], int64, int64, int64, int64)'], fastmath=True, cache=True, parallel=True)
+    def _lum_sharp(data, y0, y1, x0, x1):
+        """ Luminance and sharpness of `data[y0:y1, x0:x1]` (see `get_imgprops`) in a single 
+        pass over the image, rows being shared between threads. NOTE : the sharpness skips the 
+        1 px border of the roi (that needs neighbours), the luminance does not """
+        lum, sharp = 0.0, 0.0
+        for i in numba.prange(y0, y1):
+            row_lum, row_sharp = 0.0, 0.0
+            for j in range(x0, x1):
+                row_lum += data[i,j]
+            if y0 < i < y1-1:
+                for j in range(x0+1, x1-1):
+                    c = np.int32(data[i,j])     # Pixel values would overflow otherwise
+                    lap = 4*c - np.int32(data[i-1,j]) - np.int32(data[i+1,j]) - np.int32(data[i,j-1]) - np.int32(data[i,j+1])
+                    row_sharp += lap*lap
+            lum += row_lum          # Numba turns these into per-thread partial sums
+            sharp += row_sharp
+        npix_lum = (y1-y0)*(x1-x0)
+        npix_sharp = max((y1-y0-2)*(x1-x0-2), 1)
+        return lum/npix_lum, sharp/npix_sharp
+
+
 def get_imgprops(data:np.ndarray, roi=None):
     """ A function that builds some kind of arbitrary
     sharpness value from a numpy array (treated as an image).
@@ -78,18 +131,36 @@ def get_imgprops(data:np.ndarray, roi=None):
     ARGS
     -----
     - data : your image in np.ndarray format
-    - roi : [top, down, left, right] : the region of interest on which to focus"""
+    - roi : [top, down, left, right] : the region of interest on which to focus
+    
+    NOTE : with Numba installed, 8 and 16 bit images are dealt with in one go by `_lum_sharp`
+    NOTE : ROIs larger than 1 Mpx are downsampled 2x for the sharpness, which is then only a relative
+    value (fine for autofocus, which only looks at which image is sharper)"""
 
-    if data.ndim == 3:
-        data = data[:,:,1]
+    if data.ndim == 3:      # Green channel for BGR images, the only channel for Mono (h x w x 1) images
+        data = data[:,:,data.shape[2]//2]
 
     if roi is None:
         h, w = data.shape
         roi = [2*h//5,(3*h)//5, 2*w//5, (3*w)//5]
     data = data[roi[0]:roi[1], roi[2]:roi[3]]
-
-    lum_now = np.mean(data)
-    norm_grad = np.mean(np.abs(laplace(data - lum_now))**2) # Dividing by the std is not good since out of focus --> smaller std.
+    if data.dtype not in (np.uint8, np.uint16, np.int16, np.float32, np.float64):    # What OpenCV can filter
+        data = data.astype(np.float32)
+    lum_now = None
+    if data.size > 1e6:     # Sharpness is oversampled for big images, no need to look at every pixel
+        lum_now = cv2.mean(data)[0]     # (but the luminance is taken on the full image, the resize rounding would bias it)
+        data = cv2.resize(data, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
+    if numba is not None and data.dtype in (np.uint8, np.uint16):     # `_lum_sharp` is only compiled for these
+        numba.set_num_threads(_NUMBA_THREADS)   # Per calling thread, so it has to be done here
+        lum_small, norm_grad = _lum_sharp(data, 0, data.shape[0], 0, data.shape[1])
+        return (lum_small if lum_now is None else lum_now), norm_grad
+
+    # Same 4-neighbour stencil as scipy's `laplace`, the kernel sums to zero so no need to subtract lum_now
+    if lum_now is None:
+        lum_now = cv2.mean(data)[0]
+    lap = cv2.Laplacian(data, cv2.CV_64F if data.dtype == np.float64 else cv2.CV_32F, ksize=1)
+    np.square(lap, out=lap)
+    norm_grad = cv2.mean(lap)[0] # Dividing by the std is not good since out of focus --> smaller std.
 
     return lum_now, norm_grad
 
@@ -158,6 +229,37 @@ def init(no=0, exposure='auto', width=None, height=None, binning=1) -> Camera:
 
         return cam
 
+def _writer(save_q, save_folder='.', errors=None):
+    """ The side thread of `acquire` : takes the (index, frame) tuples from `save_q` 
+    and writes them as .tif files until it receives `None`. Encoding releases the GIL 
+    so that the camera can keep on grabbing in the meantime. If anything goes wrong,
+    the exception is appended to `errors` (for `acquire` to raise it) and the writer stops. """
+    try:
+        while True:
+            item = save_q.get()
+            if item is None:
+                break
+            saveidx, frame = item
+            # OpenCV natively deals with Mono8 and BGR8 frames, no conversion needed
+            imgurl = save_folder + f'/img_{saveidx:06d}.tif'
+            if not cv2.imwrite(imgurl, frame):      # OpenCV does not raise by itself
+                raise IOError(f'vimbacam._writer > Could not save {imgurl}')
+    except Exception as err:
+        errors.append(err)
+
+def _to_writer(save_q, item, writer, errors):
+    """ Puts `item` in `save_q` (see `acquire`). Raises the writer's exception if it failed, 
+    or a RuntimeError if it died without saying anything, instead of waiting forever """
+    while True:
+        if not writer.is_alive():
+            raise errors[0] if errors else RuntimeError('vimbacam.acquire > The writer stopped unexpectedly')
+        try:
+            save_q.put(item, timeout=0.5)
+            return
+        except queue.Full:
+            continue
+
+
 def acquire(cam: Camera, save_folder='.', dt=None, max_time=None,
                    t=None, abort_thread=None, extsave=None):
     """ ACQUIRE_FRAMES () : Runs an acquisition and saves images 
@@ -172,17 +274,11 @@ def acquire(cam: Camera, save_folder='.', dt=None, max_time=None,
     * abort_thread [threading.Event type] : the "kill switch" from main process if you want to run this as a thread 
     """  
 
-    # Write header file
-    headerstr = f'{"no":7s}\t{"texp":8s}\t{"tlocal":15s}\t{"expos":7s}\t{"lumi":7s}\t{"sharp":7s}'
-    print(headerstr)
-    with open(save_folder + '/camera_log.txt', 'w') as logfile:
-        logfile.write(headerstr.replace('\t', ',') + '\n')
-
     if max_time is not None and dt is not None:
         t_snap = np.arange(0,max_time+dt,dt)
         mysave = save(t=t_snap)
     elif t is not None:
-        t_snap = np.array(t_snap)
+        t_snap = np.array(t)
         max_time = t_snap[-1] + 1
         mysave = save(t=t_snap)
     elif max_time is not None and extsave is not None:
@@ -190,21 +286,34 @@ def acquire(cam: Camera, save_folder='.', dt=None, max_time=None,
     else:
         raise ValueError('acquire_frames > You must specify [a list of times with `t`] / [a `max_time` and a `dt`] / [a `max_time` and an external save variable]')
 
+    # Write header file (the log then stays open during the whole acquisition)
+    headerstr = f'{"no":7s}\t{"texp":8s}\t{"tlocal":15s}\t{"expos":7s}\t{"lumi":7s}\t{"sharp":7s}'
+    print(headerstr)
+    logfile = open(save_folder + '/camera_log.txt', 'w')
+    logfile.write(headerstr.replace('\t', ',') + '\n')
+
     # Acquire
     with VmbSystem.get_instance() as vmb:
         with cam:
 
             frame_handler = Handler()
             cv2.namedWindow('Live Feed')
-            pix_format = cam.get_pixel_format()
+
+            # Frames are written by a side thread. The queue is bounded so that we see it
+            # (as a slower acquisition) if the disk does not keep up, instead of filling the RAM
+            save_q = queue.Queue(maxsize=16)
+            writer_errors = []
+            writer = threading.Thread(target=_writer, args=(save_q, save_folder, writer_errors), daemon=True)
+            writer.start()
             
             try:
                 cam.start_streaming(handler=frame_handler, buffer_count=1,
                                     allocation_mode=AllocationMode.AllocAndAnnounceFrame)
-                t0 = time.time()
+                expos_feat = cam.get_feature_by_name("ExposureTime")   # Only read when we save (it is a USB round trip)
+                t0 = time.monotonic()
                 mysave.set_t0(t0=t0)
                 
-                while time.time() - t0 < max_time:
+                while time.monotonic() - t0 < max_time:
 
                     # Stop acquisition if main thread asks this function (called as a // thread) to stop
                     if abort_thread is not None and not abort_thread.is_set():
@@ -213,8 +322,7 @@ def acquire(cam: Camera, save_folder='.', dt=None, max_time=None,
 
                     frame = frame_handler.get_image()
                     timestamp = frame_handler.get_timestamp()
-                    exposure = cam.get_feature_by_name("ExposureTime").get()
-                    img_lum, img_sharp = get_imgprops(frame.astype(np.int32))
+                    img_lum, img_sharp = get_imgprops(frame)
 
                     cv2.imshow('Live Feed', frame)
                     cv2.waitKey(1)    # Enforces display & waits for 1 ms. Somehow programme crashes at the end for larger values...
@@ -227,17 +335,15 @@ def acquire(cam: Camera, save_folder='.', dt=None, max_time=None,
                     if mysave.get_trigger():
                         
                         saveidx = mysave.get_index()
+                        exposure = expos_feat.get()
 
-                        # Convert and save frame
-                        if pix_format != PixelFormat.Rgb8:
-                            rgbframe = cv2.cvtColor(frame, to_rgb[pix_format])       # Frame is initially BGR
-                        pilimg = Image.fromarray(rgbframe, mode='RGB')
-                        pilimg.save(save_folder + f'/img_{saveidx:06d}.tif')
+                        # Save frame (already a copy of the camera buffer, see `Handler`)
+                        _to_writer(save_q, (saveidx, frame), writer, writer_errors)
 
                         # # Write about the saved frame 
-                        datastr = f'{saveidx:5d}\t{time.time()-t0:8.2f}\t{timestamp:12d}\t{exposure:7.1f}\t{img_lum:5.1f}\t{img_sharp:6.2f}'
-                        with open(save_folder + '/camera_log.txt', 'w') as logfile:
-                            logfile.write(datastr.replace('\t', ',') + '\n')
+                        datastr = f'{saveidx:5d}\t{time.monotonic()-t0:8.2f}\t{timestamp:12d}\t{exposure:7.1f}\t{img_lum:5.1f}\t{img_sharp:6.2f}'
+                        logfile.write(datastr.replace('\t', ',') + '\n')
+                        logfile.flush()
                         print(datastr)
 
                         mysave.complete()
@@ -247,8 +353,17 @@ def acquire(cam: Camera, save_folder='.', dt=None, max_time=None,
                 print('acquire > Keyboard Interruption ...')
 
             finally:
+                if writer.is_alive():       # Let the writer save the remaining frames
+                    try:
+                        _to_writer(save_q, None, writer, writer_errors)
+                        writer.join()
+                    except Exception:       # The writer died in the meantime, its error is raised below
+                        pass
+                logfile.close()
                 cv2.destroyWindow('Live Feed')
                 print('vimbacam.acquire >> Camera Acquisition Complete')
+                if writer_errors:
+                    raise writer_errors[0]
 
 
 ############################# UTILITIES ###################################################################
@@ -268,19 +383,26 @@ def make_video(save_folder, expr='*.tif*', cleanup=False):
 
         # Initialise video ... (need a test frame)
         imgurls = glob.glob(save_folder + '/' + expr)
-        test_frame = Image.open(imgurls[0])
+        test_frame = cv2.imread(imgurls[0], cv2.IMREAD_COLOR)
         
         container = av.open(save_folder + '/exp.mp4', mode='w')
         stream = container.add_stream("libx265", rate=24, options={'crf':'13', 'x265-params':'log-level=error'})
         stream.pix_fmt = "yuv444p"
         stream.height, stream.width = np.shape(test_frame)[:2]
 
-        for no, imgurl in enumerate(imgurls):
-            frame = av.VideoFrame.from_image(Image.open(imgurl))
-            for packet in stream.encode(frame):
-                container.mux(packet)
-            if no % 100 == 0:
-                print(f'vimbacam.make_video > {no} / {len(imgurls)} frames', end='\r')
+        # Frames are decoded by a few side threads while the encoder works. Futures are popped in 
+        # submission order (so the video stays in order), and we keep at most 8 of them in flight.
+        n_decoders = max(1, (os.cpu_count() or 2)//2)
+        with ThreadPoolExecutor(max_workers=n_decoders) as decoder:
+            pending = deque()
+            for no in range(len(imgurls)):
+                while len(pending) < 8 and no + len(pending) < len(imgurls):
+                    pending.append(decoder.submit(cv2.imread, imgurls[no + len(pending)], cv2.IMREAD_COLOR))
+                frame = av.VideoFrame.from_ndarray(pending.popleft().result(), format='bgr24')
+                for packet in stream.encode(frame):
+                    container.mux(packet)
+                if no % 100 == 0:
+                    print(f'vimbacam.make_video > {no} / {len(imgurls)} frames', end='\r')
 
         # Finish video eventually
         for packet in stream.encode():
@@ -306,13 +428,20 @@ def make_logtimes(dt0=0.5, tmax=3600, pts_per_decade=20):
     * pts_per_decade [int] : the number of points you want to take before multiplying delta t by 10.
     """
 
+    alpha, N, dtmax, dt_scale = _logtimes(dt0, tmax, pts_per_decade)
+    T_total = np.sum(dt_scale)
+    print(f'make_logspace > N = {N:.3f} frames, total time = {T_total:.2f} s, alpha = {alpha:.2f}, dtmax = {dtmax:.3f}')
+    return dt_scale.copy() # The cached array is shared, so callers get their own copy
+
+@lru_cache(maxsize=32)
+def _logtimes(dt0, tmax, pts_per_decade):
+    """ Does the actual work of `make_logtimes` (cached, the same scales tend to be asked for over and over) """
     alpha = np.log(10)/pts_per_decade
     N = int(1/alpha*np.log(1+tmax/dt0*(np.exp(alpha)-1)))
     dtmax = dt0*np.exp(alpha*N)
     dt_scale = np.logspace(np.log10(dt0), np.log10(dtmax), N)
-    T_total = np.sum(dt_scale)
-    print(f'make_logspace > N = {N:.3f} frames, total time = {T_total:.2f} s, alpha = {alpha:.2f}, dtmax = {dtmax:.3f}')
-    return np.logspace(np.log10(dt0), np.log10(dtmax), N)
+    dt_scale.flags.writeable = False
+    return alpha, N, dtmax, dt_scale
     
 
 ######################### TESTS #############################